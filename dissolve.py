@@ -1,32 +1,63 @@
 import argparse
+import numpy as np
 import pygame
 import pygame.image
 import pygame.surfarray
-import random
-from typing import Callable
+from typing import Callable, Optional, Tuple
 
 FRAMERATE = 12.5
 DEFAULT_TRANSITION_DURATION = 4.0
 
 
+# Runs steps C-H of the dissolve starting from k=k0 and returns the pixel numbers in the order they are replaced.
+# k returns to k0 after p-1 iterations, by which point every pixel has been visited.
+def dissolve_order(pixels_total: int, p: int, m: int, k0: int) -> np.ndarray:
+    # Step H: calculating a number knew according to the formula knew = (k*m) mod p, wherein m is a primitive root of
+    # unity modulo p, and setting k=knew
+    # This makes the i'th value of k equal to k0*m^i mod p, so the whole sequence can be built by repeatedly extending
+    # it with a copy of itself multiplied by m^n mod p. Values stay below p, so the products fit in an int64.
+    k = np.empty(p - 1, dtype=np.int64)
+    k[0] = k0
+    n = 1
+    while n < len(k):
+        block = min(n, len(k) - n)
+        k[n:n + block] = k[:block] * pow(m, n, p) % p
+        n += block
+
+    # Step C: calculating a pixel number j in the current image according to the formula j=(w*h)+k-p;
+    j = pixels_total + k - p
+
+    # Step D: determining if J is non-negative
+    # Step F: Calculating a number jnew, according to the formula jnew = j-(p-1), and setting j=jnew
+    # Steps D-F produce the run j, j-(p-1), j-2(p-1), ... for as long as j stays non-negative. Lay all the runs out end
+    # to end, then subtract the right multiple of p-1 from each entry.
+    run_lengths = np.maximum(j // (p - 1) + 1, 0)
+    run_starts = np.cumsum(run_lengths) - run_lengths
+    run_index = np.arange(run_lengths.sum()) - np.repeat(run_starts, run_lengths)
+
+    # Return native index integers so the pixel numbers can be passed to take/put without being converted every frame
+    return (np.repeat(j, run_lengths) - run_index * (p - 1)).astype(np.intp)
+
+
 class Transition:
 
-    def __init__(self, width: int, height: int, swap_pixel: Callable):
+    def __init__(self, width: int, height: int, swap_pixels: Callable):
         self.width = width
         self.height = height
-        self.swap_pixel = swap_pixel
+        self.swap_pixels = swap_pixels
 
     def reset(self):
         raise NotImplementedError
 
-    def update(self, delta_ms: int) -> bool:
+    # Returns (still_running, dirty), where dirty is set if any pixels changed
+    def update(self, delta_ms: int) -> Tuple[bool, bool]:
         raise NotImplementedError
 
 
 class DissolveTransition(Transition):
 
-    def __init__(self, duration_ms: int, width: int, height: int, swap_pixel: Callable):
-        super().__init__(width, height, swap_pixel)
+    def __init__(self, duration_ms: int, width: int, height: int, swap_pixels: Callable, seed: Optional[int] = None):
+        super().__init__(width, height, swap_pixels)
 
         self.duration_ms = duration_ms
         self.elapsed_ms = 0
@@ -44,54 +75,38 @@ class DissolveTransition(Transition):
         self.m = (2 ** 15) - 1
 
         # Step B: selecting a number k=k0, where k0 is a number between 1 and p-1;
-        k0 = random.randint(1, self.p - 1)
-        self.k = k0
+        # Passing a seed makes the choice of k0, and so the whole dissolve, reproducible
+        k0 = int(np.random.default_rng(seed).integers(1, self.p))
+
+        # The pixel sequence only depends on k0, so work it out once up front
+        self.order = dissolve_order(self.pixels_total, self.p, self.m, k0)
 
     def reset(self):
         self.elapsed_ms = 0
         self.pixels_swapped = 0
 
-    def update(self, delta_ms: int) -> bool:
+    def update(self, delta_ms: int) -> Tuple[bool, bool]:
         # Check if already finished
         if self.pixels_swapped >= self.pixels_total:
-            return False
+            return False, False
 
         # Calculate elapsed time
-        self.elapsed_ms += delta_ms
-        if self.elapsed_ms >= self.duration_ms:
-            self.elapsed_ms = self.duration_ms
+        self.elapsed_ms = min(self.elapsed_ms + delta_ms, self.duration_ms)
 
         # Calculate number of pixels to swap in this frame
         pixels_to_swap = int((self.pixels_total * self.elapsed_ms) / self.duration_ms) - self.pixels_swapped
 
-        self.pixels_swapped += pixels_to_swap
-
-        while pixels_to_swap > 0:
-
-            # Step C: calculating a pixel number j in the current image according to the formula j=(w*h)+k-p;
-            j = self.pixels_total + self.k - self.p
+        # Step E: replacing the pixel corresponding to pixel number j in the first image with the corresponding pixel in
+        # the second image
+        self.swap_pixels(self.order[self.pixels_swapped:self.pixels_swapped + pixels_to_swap])
 
-            # Step D: determining if J is non-negative
-            while j > 0:
-                # Step E: replacing the pixel corresponding to pixel number j in the first image with the corresponding
-                # pixel in the second image
-                self.swap_pixel(j % self.width, j // self.width)
-
-                pixels_to_swap -= 1
-
-                # Step F: Calculating a number jnew, according to the formula jnew = j-(p-1), and setting j=jnew
-                j = j - (self.p - 1)
-
-            # Step H: calculating a number knew according to the formula knew = (k*m) mod p, wherein m is a primitive
-            # root of unity modulo p, and setting k=knew
-            knew = (self.k * self.m) % self.p
-            self.k = knew
+        self.pixels_swapped += pixels_to_swap
 
         # TODO: Update the colour palette, as described in the patent:
         # The current palette is gradually changed to the source palette by linearly interpolating each palette entry
         # between the color value in the current palette and the color value in the source palette.
 
-        return True
+        return True, pixels_to_swap > 0
 
 
 def main():
@@ -100,6 +115,7 @@ def main():
     parser.add_argument("source", nargs="?", default="source.png", help="Image to transition from")
     parser.add_argument("destination", nargs="?", default="dest.png", help="Image to transition to")
     parser.add_argument("--duration", type=float, default=DEFAULT_TRANSITION_DURATION, help="Transition duration")
+    parser.add_argument("--seed", type=int, help="Random seed, to repeat the same dissolve pattern")
 
     args = parser.parse_args()
 
@@ -115,50 +131,76 @@ def main():
     if source_image_size != dest_image.get_size():
         raise Exception("Images must be the same size")
 
-    source_pixels = pygame.surfarray.array3d(source_image)
-    dest_pixels = pygame.surfarray.array3d(dest_image)
+    # Create display window
+    screen = pygame.display.set_mode((window_width, window_height))
+    pygame.display.set_caption("3D Movie Maker dissolve - press SPACE to start/stop, ESC to restart")
 
-    # Make a copy of the source image as our starting point
-    current_state = source_pixels.copy()
+    # Convert the images to the display's pixel format so each pixel is a single packed integer
+    source_image = source_image.convert()
+    dest_image = dest_image.convert()
 
-    # Callback for swapping a pixel
-    def swap_pixel(x, y):
-        current_state[x, y] = dest_pixels[x, y]
+    # Read the destination pixels through a view of the surface rather than a copy. The view is transposed to
+    # (height, width) so that a pixel number j indexes the flattened array directly.
+    dest_pixels = np.ascontiguousarray(pygame.surfarray.pixels2d(dest_image).T)
 
-    duration_ms = int(args.duration * 1000)
-    transition = DissolveTransition(duration_ms, window_width, window_height, swap_pixel)
+    # Start from the source image. The transition then works directly on the display surface, so there's no separate
+    # copy of the current state to upload every frame.
+    screen.blit(source_image, (0, 0))
 
-    # Create display window
-    screen = pygame.display.set_mode((window_width, window_height))
-    pygame.display.set_caption("3D Movie Maker dissolve - press SPACE to start/stop, ESC to restart")
+    # Scratch space for gathering destination pixels, so that swapping doesn't allocate a new array every frame
+    swap_buffer = np.empty(dest_pixels.size, dtype=dest_pixels.dtype)
+
+    # Callback for swapping a batch of pixels. The pixel view locks the display surface, so it's only held for the
+    # duration of the swap and is released before the next flip. The pixel numbers are always in range, and
+    # mode='clip' stops take() from buffering its output, which it always does in the default mode='raise'.
+    def swap_pixels(j):
+        pixels = dest_pixels.take(j, out=swap_buffer[:len(j)], mode="clip")
+        pygame.surfarray.pixels2d(screen).T.put(j, pixels, mode="clip")
+
+    duration_ms = int(args.duration * 1000)
+    transition = DissolveTransition(duration_ms, window_width, window_height, swap_pixels, args.seed)
 
     clock = pygame.time.Clock()
 
     exit_requested = False
     running = False
+    needs_redraw = True
     while not exit_requested:
 
+        if running or needs_redraw:
+            events = pygame.event.get()
+        else:
+            # Nothing is animating, so sleep until something happens instead of polling every frame. Restart the clock
+            # afterwards so the idle time isn't counted as part of the next frame.
+            events = [pygame.event.wait()]
+            clock.tick()
+
         # Handle input
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
                 exit_requested = True
+            elif event.type == pygame.VIDEOEXPOSE:
+                needs_redraw = True
             elif event.type == pygame.KEYUP:
                 if event.key == pygame.K_SPACE:
                     running = not running
                 elif event.key == pygame.K_ESCAPE:
                     # Reset
-                    current_state = source_pixels.copy()
+                    screen.blit(source_image, (0, 0))
                     transition.reset()
+                    needs_redraw = True
 
         frame_delta = clock.tick(FRAMERATE)
 
         # Update transition
         if running:
-            running = transition.update(frame_delta)
+            running, dirty = transition.update(frame_delta)
+            needs_redraw = needs_redraw or dirty
 
-        # Render
-        pygame.surfarray.blit_array(screen, current_state)
-        pygame.display.flip()
+        # Render, but only if something changed
+        if needs_redraw:
+            pygame.display.flip()
+            needs_redraw = False
 
 
 if __name__ == '__main__':